@@ -7,6 +7,38 @@ import argparse
 import cv2
 import time
 import numpy as np
+from threading import Thread
+
+NUMBA = True
+try:
+    from numba import njit, prange
+except ImportError:
+    NUMBA = False
+
+
+if NUMBA:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def accumulate_gray(bgr, acc):
+        """
+        Convert a BGR frame to grayscale and add it into the stacking
+        accumulator in place, touching each pixel only once. Uses the same
+        14 bit fixed point BT.601 weights as cv2.COLOR_BGR2GRAY. Rows are
+        split across threads and each row is a plain contiguous loop so
+        LLVM can vectorize it.
+
+        The sum is stored back without saturation, so it wraps if acc is
+        already full. Callers must keep the number of stacked frames at or
+        below np.iinfo(acc.dtype).max // 255, as Snapshot.expose does.
+
+        Args:
+            bgr (np.ndarray): uint8 BGR frame
+            acc (np.ndarray): uint16 or int32 accumulator of the frame's height and width
+        """
+        for r in prange(bgr.shape[0]):
+            for c in range(bgr.shape[1]):
+                acc[r, c] += (
+                    bgr[r, c, 0] * 1868 + bgr[r, c, 1] * 9617 + bgr[r, c, 2] * 4899 + 8192
+                ) >> 14
 
 class Snapshot:
     """Class to facilitate taking a simple snapshot of some determined exposure."""
@@ -26,34 +58,122 @@ class Snapshot:
         self.image = None
 
         self.cam = cv2.VideoCapture(self.src)
-        self.start = time.time()
+        # Keep only the newest frame in the driver so stacking starts fresh
+        self.cam.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        # Size the stacking accumulator off of a first frame. A full
+        # exposure of saturated pixels usually fits in 16 bits, which halves
+        # the memory traffic of stacking. Otherwise (or if the camera does
+        # not report its fps) fall back to 32 bits. The reported fps is only
+        # a guess, so expose also counts frames and widens to 32 bits before
+        # the stack could ever overflow.
+        grabbed, frame = self.cam.read()
+        if not grabbed:
+            self.cam.release()
+            raise RuntimeError("Could not read a frame from video source {}".format(self.src))
+        fps = self.cam.get(cv2.CAP_PROP_FPS)
+        if 0 < fps and self.exposure * fps * 255 < 65000:
+            dtype = np.uint16
+        else:
+            dtype = np.int32
+        self.image = np.zeros(frame.shape[:2], dtype=dtype)
+        # Frames stacked so far, and how many fit without overflowing
+        self.nframes = 0
+        self.capacity = np.iinfo(dtype).max // 255
+        # Reused color buffer so no new array is made each frame
+        self._raw = frame
+        if NUMBA:
+            # Compile (or load the cached) kernel before the exposure starts,
+            # including the int32 version expose may widen to part way in
+            accumulate_gray(np.zeros_like(self._raw), self.image)
+            if dtype == np.uint16:
+                accumulate_gray(np.zeros_like(self._raw), self.image.astype(np.int32))
+        else:
+            # Grayscale frames are gathered in batches and summed together,
+            # which costs far fewer NumPy calls than adding them one by one
+            self._stack = np.empty((8,) + frame.shape[:2], dtype=np.uint8)
+            self._sum = np.empty_like(self.image)
+        self.start = time.monotonic()
         self.expose()
-        cv2.imwrite("{path}/Manual_{fname}.png".format(path=self.location, fname=time.strftime('%Y%m%d_%H%M%S')), self.image)
+        # Encode the PNG on a separate thread so a following capture need
+        # not wait on it. expose builds a new array each time, so the one
+        # handed to the thread is never modified afterwards.
+        path = "{path}/Manual_{fname}.png".format(path=self.location, fname=time.strftime('%Y%m%d_%H%M%S'))
+        self.thread = Thread(target=cv2.imwrite, args=(path, self.image))
+        self.thread.daemon = False
+        self.thread.start()
 
     def expose(self):
         """
         Gather frames from camera and stack (add) them until the
-        desired exposure time is reached. Then normalize, stretch,
-        and convert back to int8.
+        desired exposure time is reached. The stack is left untouched
+        until the end, then linearly stretched so its brightest pixel
+        is 255 and converted back to uint8 in a single pass.
 
         Arguments:
             None
         Outputs:
             None
         """
-        while time.time() - self.start < self.exposure:
-            grabbed, frame = self.cam.read()
-            if grabbed:
-                frame = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
-                frame = frame.astype(np.int32)
-                if self.image is None:
-                    self.image = frame
+        end = self.start + self.exposure
+        count = 0
+        while time.monotonic() < end:
+            if self.cam.grab() and self.cam.retrieve(self._raw)[0]:
+                # Never stack more frames than the accumulator can hold
+                if self.nframes == self.capacity:
+                    if self.image.dtype != np.uint16:
+                        # Even 32 bits is full, so end the exposure here
+                        break
+                    self.widen()
+                self.nframes += 1
+                if NUMBA:
+                    accumulate_gray(self._raw, self.image)
                 else:
-                    self.image += frame
-        # Stretch image
-        normalize = self.image / np.max(self.image)
-        # Set back to int8
-        self.image = (normalize * 255).astype(np.uint8)
+                    cv2.cvtColor(self._raw, cv2.COLOR_BGR2GRAY, dst=self._stack[count])
+                    count += 1
+                    if count == len(self._stack):
+                        self.add_stack(count)
+                        count = 0
+        # Add in any partial batch left over
+        if count:
+            self.add_stack(count)
+        # Stretch image so the max is 255 and set back to uint8 in one pass.
+        # The stack is integer, so a max of 1 guards an all black exposure.
+        _, maxv, _, _ = cv2.minMaxLoc(self.image)
+        self.image = cv2.convertScaleAbs(
+            self.image, alpha=255.0 / max(maxv, 1), beta=0.0
+        )
+
+    def widen(self):
+        """
+        Move the stack into a 32 bit accumulator once the 16 bit one holds
+        as many frames as it can without overflowing. Frames still waiting
+        in the batch are uint8, so they are unaffected.
+
+        Arguments:
+            None
+        Outputs:
+            None
+        """
+        self.image = self.image.astype(np.int32)
+        self.capacity = np.iinfo(np.int32).max // 255
+        if not NUMBA:
+            self._sum = np.empty_like(self.image)
+
+    def add_stack(self, count):
+        """
+        Sum the first count gathered grayscale frames in a single
+        reduction and add the result into the accumulated image.
+
+        Arguments:
+            count (int): Number of frames currently in the batch
+        Outputs:
+            None
+        """
+        np.sum(self._stack[:count], axis=0, dtype=self.image.dtype, out=self._sum)
+        # np.add wraps rather than saturates on overflow. That cannot happen
+        # here only because expose never stacks past self.capacity frames
+        # (widening to int32 first), so keep that check ahead of any add.
+        np.add(self.image, self._sum, out=self.image)
 
 
 def read_arguments():
@@ -1,22 +1,34 @@
 # Importing all the necessities
 from collections import deque
-from threading import Thread
-from queue import Queue
-import time
+from enum import Enum
+from threading import Thread, Event, Condition, Lock
+import numpy as np
+import logging
 import os
 import cv2
 
+d6log = logging.getLogger("D6")
+
 
 class KeyClipWriter:
-    def __init__(self, bufSize=64, timeout=1.0):
+    def __init__(self, bufSize=64, timeout=1.0, queueSize=256):
         # Maximum number of frames to be kept in memory
         self.bufSize = bufSize
-        # Sleep timeout for threading to prevent lock competition
+        # Longest the idle writer thread waits before checking the queue
+        # again. Queued frames and shutdown both wake it immediately.
         self.timeout = timeout
+        # Maximum number of frames waiting to be encoded. If the encoder
+        # falls this far behind, the oldest waiting frame is dropped so
+        # that update never blocks the capture loop. Frames dropped from
+        # the current recording are counted in dropped.
+        self.queueSize = queueSize
+        self.dropped = 0
 
         # Initialize everything
         self.frames = deque(maxlen=bufSize)
         self.Q = None
+        # Signals the writer thread that new frames were queued
+        self._has_work = Event()
         self.writer = None
         self.thread = None
         self.recording = False
@@ -29,7 +41,15 @@ class KeyClipWriter:
 
         # If we are also recording, add the frame to the write queue as well
         if self.recording:
-            self.Q.put(frame)
+            self.try_write(frame)
+
+    def try_write(self, frame):
+        # Queue a frame for the writer thread without ever blocking. The
+        # queue is bounded, so once full the oldest frame is dropped.
+        if len(self.Q) == self.Q.maxlen:
+            self.dropped += 1
+        self.Q.append(frame)
+        self._has_work.set()
 
     def start(self, outputPath, fourcc, fps, isColor=True):
         # Set recording flag
@@ -43,12 +63,13 @@ class KeyClipWriter:
             (self.frames[0].shape[1], self.frames[0].shape[0]),
             isColor,
         )
-        # Initialize queue of frames to be written
-        self.Q = Queue()
+        # Initialize queue of frames to be written. Appending on one end
+        # and popping from the other is atomic, so no lock is needed.
+        self.Q = deque(maxlen=self.queueSize)
+        self.dropped = 0
 
         # Add everything currently in the frames buffer to the queue
-        for i in range(len(self.frames), 0, -1):
-            self.Q.put(self.frames[i - 1])
+        self.Q.extend(reversed(self.frames))
 
         # Start a thread to write the frames
         self.thread = Thread(target=self.write, args=())
@@ -58,42 +79,44 @@ class KeyClipWriter:
     def write(self):
         # Start up the writing loop
         while True:
-            # If done recording, exit thread
-            if not self.recording:
+            # Grab the next frame and write it!
+            try:
+                frame = self.Q.popleft()
+            # Otherwise, wait for update to queue more frames
+            except IndexError:
+                self._has_work.wait(timeout=self.timeout)
+                self._has_work.clear()
+                continue
+
+            # A None frame marks the end of the recording
+            if frame is None:
                 return
-
-            # Are there frames in the queue?
-            if not self.Q.empty():
-                # Then grab the next frame and write it!
-                frame = self.Q.get()
-                self.writer.write(frame)
-            # Otherwise, sleep for a moment to not interfere with the update process
-            else:
-                time.sleep(self.timeout)
-
-    def flush(self):
-        # Empty the queue by writing out the rest of what is in it
-        time1 = time.time()
-        while not self.Q.empty():
-            frame = self.Q.get()
             self.writer.write(frame)
-        time2 = time.time()
-        # print("Flush elapsed time was: {}".format(time2-time1))
 
     def finish(self):
-        # Set recording flag
+        # Set recording flag and let the writer thread drain the queue
         self.recording = False
+        self.try_write(None)
         self.thread.join()
-        self.flush()
         self.writer.release()
 
     def terminate(self):
         self.recording = False
+        self.Q.clear()
+        self.try_write(None)
         self.thread.join()
         self.writer.release()
         os.remove(self.outputPath)
 
 
+class UpdateStatus(Enum):
+    """Result of ShortClipWriter.update, letting the caller know whether
+    the frame it just passed in will end up in a saved clip."""
+
+    OK = 0
+    TOO_LONG_DROP = 1
+
+
 class ShortClipWriter:
     """Class to better manage writing out video files on a running basis"""
 
@@ -105,9 +128,8 @@ class ShortClipWriter:
 
         # Initialize everything
         self.frames = deque(maxlen=bufSize)
-        self.Q = None
-        self.writer = None
-        self.threads = []
+        self.ring = None
+        self.idx = 0
         self.recording = False
         self.outputPath = None
         self.toolong = False
@@ -115,21 +137,53 @@ class ShortClipWriter:
         self.fps = 30
         self.is_color = True
 
+        # Finished clips waiting to be encoded. Clips are never dropped;
+        # each one is already capped at max_frames, so this stays small.
+        self.clips = deque()
+        # Encoder thread, only running while there are clips to write, and
+        # the lock that keeps it from exiting as a new clip is queued
+        self.thread = None
+        self.encoding = False
+        self.lock = Lock()
+
     def update(self, frame):
         """Update both the rolling buffer and, if recording,
         update the video buffer as well. Takes a single np.array
         as a frame.
+
+        Returns UpdateStatus.TOO_LONG_DROP once the current recording
+        has run past max_frames and will be discarded, so the caller
+        knows any further frames of this event are not being kept.
         """
         # Add frame to the frame buffer
         self.frames.append(frame)
 
         # If we are also recording, add the frame to the write queue as well
         if self.recording:
-            # We only want short clips, so flag long recordings
-            if len(self.Q) > self.rec_max_frames:
+            # Already too long, so nothing more is worth storing
+            if self.toolong:
+                return UpdateStatus.TOO_LONG_DROP
+            # We only want short clips, so flag long recordings and free
+            # the block now, as it will never be written
+            if self.idx > self.rec_max_frames:
                 self.toolong = True
-            else:
-                self.Q.append(frame)
+                self.ring = None
+                return UpdateStatus.TOO_LONG_DROP
+            self.store(frame)
+        return UpdateStatus.OK
+
+    def store(self, frame):
+        """Copies a frame into the next slot of the recording block,
+        allocating the block off of the first frame stored.
+        """
+        if self.ring is None:
+            # Initialize a single contiguous block for every frame a short
+            # clip can hold. np.empty only reserves the memory, so pages are
+            # not touched until frames are actually copied in.
+            size = max(len(self.frames), self.rec_max_frames + 1)
+            self.ring = np.empty((size,) + frame.shape, dtype=frame.dtype)
+        np.copyto(self.ring[self.idx], frame)
+        self.idx += 1
 
     def start(self, output_path, fourcc, fps, is_color=True):
         """Starts a video recording event, setting the output path and
@@ -148,56 +202,150 @@ class ShortClipWriter:
         self.fps = fps
         self.is_color = is_color
 
-        # Initialize queue of frames to be written
-        self.Q = deque()
+        # The block is sized off of the first frame stored, so starting
+        # before any update has been made is fine
+        self.ring = None
+        self.idx = 0
 
-        # Add everything currently in the frames buffer to the queue
-        self.Q.extend(self.frames)
+        # Add everything currently in the frames buffer to the block
+        for frame in self.frames:
+            self.store(frame)
 
-    def write(self):
-        """Takes every frame in the provided framelist deque and writes
+    def write(self, output_path, fourcc, fps, is_color, frames):
+        """Takes every frame in the provided block and writes
         to video, releasing the writer upon conclusion.
 
-        framelist: (deque) Queue of np.array frames to be written to video
+        frames: (np.array) Block of frames to be written to video
         """
-        # Lock in current framelist
-        framelist = self.Q.copy()
         # Initialize writer
         writer = cv2.VideoWriter(
-            self.outputPath,
-            self.fourcc,
-            self.fps,
-            (framelist[0].shape[1], framelist[0].shape[0]),
-            self.is_color,
+            output_path,
+            fourcc,
+            fps,
+            (frames.shape[2], frames.shape[1]),
+            is_color,
         )
-        while len(framelist) > 0:
-            frame = framelist.popleft()
+        for frame in frames:
             writer.write(frame)
         writer.release()
 
+    def encode(self):
+        """Runs on the encoder thread, writing out each queued clip in
+        turn and exiting once none are left.
+        """
+        while True:
+            with self.lock:
+                if not self.clips:
+                    self.encoding = False
+                    return
+                clip = self.clips.popleft()
+            # One clip failing to write must not stop the ones behind it
+            try:
+                self.write(*clip)
+            except Exception:
+                d6log.exception("Failed to write video clip {}".format(clip[0]))
+
     def finish(self):
         """Upon conclusion of an event, stops the recording and sends
-        the queue of frames to a separate thread to do the writing to
+        the recorded frames to the encoder thread to do the writing to
         disk.
         """
         # Set recording flag
         self.recording = False
 
-        if not self.toolong:
-            # Start a thread to write the frames
-            self.threads.append(Thread(target=self.write, args=(),))
-            self.threads[-1].daemon = False
-            self.threads[-1].start()
+        # Hand the recorded block over to the encoder thread outright, so
+        # the next start cannot touch it and a discarded clip is freed now
+        ring, self.ring = self.ring, None
+        count, self.idx = self.idx, 0
+
+        # Nothing to write if no frames were ever recorded
+        if not self.toolong and ring is not None:
+            # Queue the clip, starting the encoder thread if it is idle. The
+            # thread is not a daemon, so the process stays alive until every
+            # queued clip is on disk.
+            with self.lock:
+                self.clips.append(
+                    (self.outputPath, self.fourcc, self.fps, self.is_color, ring[:count])
+                )
+                if not self.encoding:
+                    self.encoding = True
+                    self.thread = Thread(target=self.encode, args=())
+                    self.thread.daemon = False
+                    self.thread.start()
+
+    def close(self):
+        """Waits for every queued clip to be written to disk."""
+        with self.lock:
+            thread = self.thread
+        if thread is not None:
+            thread.join()
+
+
+class FramePool:
+    """Fixed set of preallocated frames that are handed out and returned
+    through a free list, so capturing reuses the same few arrays rather
+    than allocating a new one for every frame.
+    """
+
+    def __init__(self, size, shape, dtype=np.uint8):
+        """
+        size: (int) number of frames to preallocate
+        shape: (tuple) shape of each frame
+        dtype: (np.dtype) datatype of each frame
+        """
+        # Popping and appending a deque are atomic, so no lock is needed
+        self.free = deque(np.empty(shape, dtype=dtype) for _ in range(size))
+
+    def acquire(self):
+        """Returns a free frame, or None if every frame is in use."""
+        try:
+            return self.free.popleft()
+        except IndexError:
+            return None
+
+    def release(self, frame):
+        """Hands a frame back to the pool once it is no longer needed."""
+        self.free.append(frame)
 
 
 class VideoStream:
-    def __init__(self, src=0):
-        # Initialize and read first frame
+    """Threaded camera reader that decodes frames into a fixed pool of
+    reused arrays.
+
+    By default the array returned by read is borrowed from that pool and
+    is overwritten by a later frame once read is called again. Callers
+    that hold on to frames past the next read, such as KeyClipWriter and
+    ShortClipWriter which keep them in their rolling buffers, must use
+    read(copy=True) to get an array of their own.
+    """
+
+    def __init__(self, src=0, bufSize=32):
+        # Initialize and read first frame. The driver is asked to hold just
+        # one frame, since the pool below is where frames are buffered and
+        # so bufSize is the total number of frames in flight.
         self.stream = cv2.VideoCapture(src)
+        self.stream.set(cv2.CAP_PROP_BUFFERSIZE, 1)
         self.grabbed, self.frame = self.stream.read()
         # Stopping variable
         self.stopped = False
-        self.Q = Queue()
+        # Pool of preallocated frames the camera decodes straight into. The
+        # frame last handed out by read stays out of the pool until the next
+        # read, so at most bufSize - 1 frames are ever waiting to be read.
+        # If the reader falls behind and the pool runs dry, newly grabbed
+        # frames are dropped without being decoded (counted in dropped), so
+        # memory and latency both stay bounded.
+        self.bufSize = bufSize
+        # With no first frame there is nothing to size the pool from, and the
+        # stream has already ended, so read will just return None.
+        self.pool = None
+        if self.grabbed:
+            self.pool = FramePool(bufSize, self.frame.shape, self.frame.dtype)
+        # Decoded frames waiting to be read, and the one last handed out
+        self.Q = deque()
+        self.held = None
+        self.dropped = 0
+        # Guards the queue and wakes read when a frame arrives
+        self._has_frame = Condition()
 
     def start(self):
         # Start the thread to read from video stream
@@ -205,23 +353,56 @@ class VideoStream:
         return self
 
     def update(self):
-        # Loop forever until stopped
-        while True:
+        # Loop forever until stopped or the stream ends
+        while self.grabbed:
             # Break out if stopped
             if self.stopped:
                 return
 
-            # Else, read next frame from stream
-            # self.grabbed, self.frame = self.stream.read()
-            self.Q.put(self.stream.read()[1])
-            # self.Q.put(self.frame)
+            # Else, grab the next frame from the stream
+            grabbed = self.stream.grab()
+            if grabbed:
+                frame = self.pool.acquire()
+                if frame is None:
+                    # Reader is behind, so drop this frame before decoding it
+                    self.dropped += 1
+                    continue
+                # Decode it into the free frame
+                grabbed, _ = self.stream.retrieve(frame)
+                if not grabbed:
+                    self.pool.release(frame)
+            with self._has_frame:
+                self.grabbed = grabbed
+                if grabbed:
+                    self.Q.append(frame)
+                self._has_frame.notify_all()
+            if not grabbed:
+                return
 
-    def read(self):
-        # Return latest frame
-        while True:
-            if not self.Q.empty():
-                return self.Q.get()
+    def read(self, copy=False):
+        # Return oldest unread frame, which stays valid until the next read
+        # unless copy is set, in which case the caller gets its own array.
+        # Sleeps until one is available, or returns None if the stream ended.
+        with self._has_frame:
+            while not self.Q and self.grabbed and not self.stopped:
+                self._has_frame.wait()
+            # The caller is done with the previous frame, so recycle it
+            if self.held is not None:
+                self.pool.release(self.held)
+                self.held = None
+            if not self.Q:
+                return None
+            frame = self.Q.popleft()
+            if copy:
+                # Hand back a copy and recycle the pooled frame right away
+                out = frame.copy()
+                self.pool.release(frame)
+                return out
+            self.held = frame
+            return self.held
 
     def stop(self):
         # Indicate the thread should be stopped
-        self.stopped = True
+        with self._has_frame:
+            self.stopped = True
+            self._has_frame.notify_all()
@@ -195,7 +195,7 @@ def analyze(buffsize, savepath, headless, vpath=None, delay=1):
 
     # Get masked image
     mask = cv2.imread("Images/Current_Loc_Mask.png")
-    mask = cv2.cvtColor(mask, cv2.COLOR_RGB2GRAY)
+    mask = cv2.cvtColor(mask, cv2.COLOR_BGR2GRAY)
     _, mask = cv2.threshold(mask, 100, 255, cv2.THRESH_BINARY)
 
     # Grab one frame to initialize
@@ -281,7 +281,7 @@ def analyze(buffsize, savepath, headless, vpath=None, delay=1):
             updateConsecFrames = True
 
             # Process Frame
-            gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
             B = gray.copy()
 
             # Mask image
@@ -443,6 +443,8 @@ def analyze(buffsize, savepath, headless, vpath=None, delay=1):
         if disk_full:
             break
 
+    # Let any clips still being encoded finish writing to disk
+    kcw.close()
     d6log.info("Observing session finished.")
 
 
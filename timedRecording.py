@@ -70,7 +70,7 @@ def main():
 
     while datetime.now() <= endtime:
         frame = cam.read()[1]
-        frame = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
         cv2.putText(frame,
                 datetime.now().strftime('%Y%m%d_%H%M%S.%f'),
                 (10, frame.shape[0]-10),